@@ -1,24 +1,38 @@
+import functools
 import sqlite3
-from contextlib import contextmanager
+import threading
+from typing import Iterable, Optional, Tuple
 from fastapi import Header, HTTPException
 
 # نام فایل پایگاه داده
 DB_NAME = "/app/config/apikeys.db"
 
+# کوئری اعتبارسنجی (ماژول sqlite3 دستورات را بر اساس متن SQL کش می‌کند)
+_VALIDATE_STMT = "SELECT 1 FROM api_keys WHERE key = ? LIMIT 1"
+
+# اتصال مشترک به دیتابیس؛ sqlite3 thread-safe نیست پس دسترسی با قفل انجام می‌شود
+_conn = None
+_lock = threading.Lock()
+
 # مدیریت اتصال به دیتابیس
-@contextmanager
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+    """بازگرداندن اتصال مشترک (در صورت نیاز ایجاد می‌شود)"""
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                _conn = conn
+    return _conn
 
 # مقداردهی اولیه پایگاه داده
 def initialize_db():
     """ایجاد جدول API Key‌ها در صورت عدم وجود"""
-    with get_db_connection() as conn:
+    conn = get_db_connection()
+    with _lock:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS api_keys (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -27,27 +41,45 @@ def initialize_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         """)
-        conn.commit()
 
 # افزودن API Key جدید
 def add_api_key(api_key: str, description: str = None):
     """افزودن API Key جدید به پایگاه داده"""
-    with get_db_connection() as conn:
+    conn = get_db_connection()
+    with _lock:
         conn.execute("""
         INSERT INTO api_keys (key, description) VALUES (?, ?)
         """, (api_key, description))
-        conn.commit()
+    validate_api_key.cache_clear()
+
+# افزودن گروهی API Key ها
+def add_api_keys(pairs: Iterable[Tuple[str, Optional[str]]]):
+    """افزودن چند API Key در یک تراکنش (یک commit برای همه)"""
+    conn = get_db_connection()
+    with _lock:
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("""
+            INSERT INTO api_keys (key, description) VALUES (?, ?)
+            """, pairs)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    validate_api_key.cache_clear()
 
-# اعتبارسنجی API Key
+# اعتبارسنجی API Key (نتایج مثبت و منفی در حافظه کش می‌شوند)
+@functools.lru_cache(maxsize=4096)
 def validate_api_key(api_key: str) -> bool:
     """بررسی صحت API Key در پایگاه داده"""
-    with get_db_connection() as conn:
-        result = conn.execute("""
-        SELECT 1 FROM api_keys WHERE key = ?
-        """, (api_key,)).fetchone()
-        return result is not None
+    conn = get_db_connection()
+    with _lock:
+        result = conn.execute(_VALIDATE_STMT, (api_key,)).fetchone()
+    return result is not None
 
 # Dependency برای FastAPI
+# باید def (و نه async def) بماند تا FastAPI آن را در threadpool اجرا کند و
+# خواندن از SQLite (در صورت نبود در کش) حلقه رویداد را مسدود نکند
 def validate_api_key_dependency(x_api_key: str = Header(...)):
     """Dependency برای بررسی API Key در درخواست‌ها"""
     if not validate_api_key(x_api_key):
@@ -1,14 +1,29 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 
 def setup_logging():
-    """تنظیمات اولیه لاگ"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler("api.log"),  # ذخیره لاگ‌ها در فایل
-            logging.StreamHandler()         # نمایش لاگ‌ها در کنسول
-        ]
-    )
+    """تنظیمات اولیه لاگ
+
+    رکوردها از طریق صف به یک thread پس‌زمینه داده می‌شوند تا نوشتن در فایل
+    و کنسول حلقه رویداد را مسدود نکند.
+    """
+    log_queue = queue.Queue(-1)
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handlers = [
+        logging.FileHandler("api.log"),  # ذخیره لاگ‌ها در فایل
+        logging.StreamHandler()         # نمایش لاگ‌ها در کنسول
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))  # قالب نهایی در listener اعمال می‌شود
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
     logger = logging.getLogger("FastAPIApp")
     return logger
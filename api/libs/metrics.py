@@ -1,6 +1,11 @@
-from prometheus_client import Counter, Summary, make_asgi_app
+from prometheus_client import Counter, Histogram, make_asgi_app
 
 REQUEST_COUNT = Counter("request_count", "Total number of requests", ["method", "endpoint", "status"])
-REQUEST_LATENCY = Summary("request_latency_seconds", "Request latency in seconds", ["endpoint"])
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Request latency in seconds",
+    ["method", "handler", "status"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+)
 
 metrics_app = make_asgi_app()
@@ -1,6 +1,50 @@
-import redis.asyncio as aioredis
-from fastapi_limiter import FastAPILimiter
+from redis.exceptions import NoScriptError
 
-async def initialize_rate_limiter(redis_url: str):
-    redis = aioredis.from_url(redis_url, encoding="utf8", decode_responses=True)
-    await FastAPILimiter.init(redis)
+# اسکریپت Lua برای پنجره لغزان با Sorted Set (یک رفت‌وبرگشت و به صورت اتمیک)
+# KEYS[1]: کلید IP + مسیر، KEYS[2]: کلید سراسری
+# ARGV: now_ms, request_id, ip_limit, ip_window_ms, global_limit, global_window_ms
+# خروجی: {0, 0} در صورت مجاز بودن، در غیر این صورت {شماره محدودیت نقض‌شده, retry_after_ms}
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+for i = 1, 2 do
+    local limit = tonumber(ARGV[1 + 2 * i])
+    local window = tonumber(ARGV[2 + 2 * i])
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, now - window)
+    if redis.call('ZCARD', KEYS[i]) >= limit then
+        local oldest = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+        return {i, tonumber(oldest[2]) + window - now}
+    end
+end
+local member = ARGV[1] .. ':' .. ARGV[2]
+for i = 1, 2 do
+    redis.call('ZADD', KEYS[i], now, member)
+    redis.call('PEXPIRE', KEYS[i], ARGV[2 + 2 * i])
+end
+return {0, 0}
+"""
+
+# شماره محدودیت‌ها در خروجی اسکریپت
+IP_LIMIT_EXCEEDED = 1
+GLOBAL_LIMIT_EXCEEDED = 2
+
+rate_limit_redis = None
+sliding_window_sha = None
+
+async def initialize_rate_limiter(redis):
+    """استفاده از کلاینت Redis موجود (با pool محدود و timeout) برای Rate Limiting"""
+    global rate_limit_redis, sliding_window_sha
+    rate_limit_redis = redis
+    sliding_window_sha = await rate_limit_redis.script_load(SLIDING_WINDOW_SCRIPT)
+
+async def check_rate_limit(ip_key: str, global_key: str, ip_limit: int, ip_window_ms: int,
+                           global_limit: int, global_window_ms: int, now_ms: int, request_id: str):
+    """بررسی محدودیت IP و سراسری با یک EVALSHA؛ خروجی (limit_exceeded, retry_after_ms)"""
+    global sliding_window_sha
+    args = (now_ms, request_id, ip_limit, ip_window_ms, global_limit, global_window_ms)
+    try:
+        exceeded, retry_after_ms = await rate_limit_redis.evalsha(sliding_window_sha, 2, ip_key, global_key, *args)
+    except NoScriptError:
+        # کش اسکریپت Redis پاک شده (مثلا پس از ری‌استارت)؛ دوباره بارگذاری می‌شود
+        sliding_window_sha = await rate_limit_redis.script_load(SLIDING_WINDOW_SCRIPT)
+        exceeded, retry_after_ms = await rate_limit_redis.evalsha(sliding_window_sha, 2, ip_key, global_key, *args)
+    return exceeded, retry_after_ms
@@ -1,33 +1,37 @@
 from fastapi import FastAPI, Depends, Header, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_limiter.depends import RateLimiter
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, Union
-from datetime import datetime
-import json
+import logging
+import orjson
 import os
-import redis
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 import sqlite3
-import sys
+import time
+import uuid
 
-sys.path.append(r"libs")
-sys.stdin.reconfigure(encoding='utf-8')
-sys.stdout.reconfigure(encoding='utf-8')
-
-from apikey_manager import initialize_db, add_api_key, validate_api_key_dependency
-from metrics import metrics_app, REQUEST_LATENCY, REQUEST_COUNT
-from rate_limiter import initialize_rate_limiter
-from logging_config import setup_logging
+from libs.apikey_manager import initialize_db, add_api_key, validate_api_key_dependency
+from libs.metrics import metrics_app, REQUEST_LATENCY, REQUEST_COUNT
+from libs.rate_limiter import initialize_rate_limiter, check_rate_limit, GLOBAL_LIMIT_EXCEEDED
+from libs.logging_config import setup_logging
 
 # بارگذاری تنظیمات از فایل config.json
 CONFIG_PATH = "config/config.json"
 if not os.path.exists(CONFIG_PATH):
     raise FileNotFoundError(f"Config file not found: {CONFIG_PATH}")
 
-with open(CONFIG_PATH, "r") as config_file:
-    config = json.load(config_file)
+with open(CONFIG_PATH, "rb") as config_file:
+    config = orjson.loads(config_file.read())
 
-REDIS_URL = f"redis://:{config['REDIS_PASSWORD']}@{config['REDIS_HOST']}:{config['REDIS_PORT']}/0"
+REDIS_HOST = config["REDIS_HOST"]
+REDIS_PORT = config["REDIS_PORT"]
+REDIS_PASSWORD = config["REDIS_PASSWORD"]
+REDIS_URL_BASE = f"redis://:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/"
 ADMIN_API_KEY = config["ADMIN_API_KEY"]
 
 # تنظیمات لاگ
@@ -41,6 +45,8 @@ class KeyValueInput(BaseModel):
     ttl: Optional[int] = Field(None, ge=1)
 
 class KeyValueOutput(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     key: str
     value: Optional[str]
     ttl: Optional[int]
@@ -48,6 +54,8 @@ class KeyValueOutput(BaseModel):
     message: str
 
 class TTLResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     key: str
     ttl: Union[int, str]
     db_index: int
@@ -55,18 +63,10 @@ class TTLResponse(BaseModel):
 # برنامه FastAPI
 app = FastAPI()
 
-# دیکشنری کانکشن‌ها
+# دیکشنری Connection Pool ها و کلاینت‌های Redis (یکی برای هر db_index)
+redis_pools = {}
 redis_connections = {}
 
-# افزودن CORS Middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # مونت کردن متریک‌ها
 app.mount("/metrics", metrics_app)
 
@@ -75,91 +75,174 @@ app.mount("/metrics", metrics_app)
 async def startup():
     logger.info("Starting application...")
     initialize_db()
-    await initialize_rate_limiter(REDIS_URL)
+    for db_index in range(16):
+        redis_pools[db_index] = aioredis.BlockingConnectionPool.from_url(
+            f"{REDIS_URL_BASE}{db_index}",
+            decode_responses=True,
+            max_connections=32,
+            timeout=2,  # حداکثر زمان انتظار برای آزاد شدن یک کانکشن
+            socket_timeout=2,
+            socket_connect_timeout=1,
+            health_check_interval=30,
+            # فقط خطای اتصال تکرار می‌شود؛ پس از timeout ممکن است دستور (SET NX/XX، DEL) اجرا شده باشد
+            retry=Retry(ExponentialBackoff(cap=0.5, base=0.05), 3, supported_errors=(RedisConnectionError,)),
+            retry_on_error=[RedisConnectionError],
+        )
+        redis_connections[db_index] = aioredis.Redis(connection_pool=redis_pools[db_index])
+    await initialize_rate_limiter(redis_connections[0])
+    preregister_metric_labels()
     logger.info("Application started successfully.")
 
 @app.on_event("shutdown")
 async def shutdown():
     logger.info("Shutting down application.")
+    for pool in redis_pools.values():
+        await pool.disconnect()
 
-# Middleware برای رهگیری درخواست‌ها و محاسبه متریک‌ها
-@app.middleware("http")
-async def prometheus_middleware(request: Request, call_next):
-    endpoint = request.url.path
-    method = request.method
-    ip_address = request.client.host
-    logger.info(f"Request from IP: {ip_address}, Endpoint: {endpoint}, Method: {method}")
-    with REQUEST_LATENCY.labels(endpoint=endpoint).time():
-        response = await call_next(request)
-        status_code = response.status_code
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=str(status_code)).inc()
-    return response
+# مسیرهایی که متریک، لاگ و Rate Limit برای آن‌ها ثبت نمی‌شود
+EXCLUDED_PATHS = frozenset({"/metrics", "/metrics/", "/health", "/docs", "/redoc", "/openapi.json"})
+
+# کش زیرمتریک‌ها به ازای (method, endpoint, status_code)
+_counter_children = {}
+_latency_children = {}
+
+# کدهای وضعیتی که API برمی‌گرداند
+KNOWN_STATUS_CODES = (200, 400, 403, 404, 422, 429, 500)
+
+def _counter_child(method: str, endpoint: str, status_code: int):
+    child = _counter_children[(method, endpoint, status_code)] = REQUEST_COUNT.labels(method, endpoint, str(status_code))
+    return child
+
+def _latency_child(method: str, endpoint: str, status_code: int):
+    child = _latency_children[(method, endpoint, status_code)] = REQUEST_LATENCY.labels(method, endpoint, str(status_code))
+    return child
+
+# مسیرهای route های API (برای برچسب‌گذاری پاسخ‌هایی که به مسیریابی نمی‌رسند)
+_route_paths = frozenset()
+
+# ثبت پیشاپیش زیرمتریک‌های counter برای همه route ها تا در مسیر درخواست labels() صدا زده نشود
+# (زیرمتریک‌های latency در اولین استفاده ساخته می‌شوند تا سری‌های همیشه صفر ایجاد نشوند)
+def preregister_metric_labels():
+    global _route_paths
+    _route_paths = frozenset(route.path for route in app.routes if isinstance(route, APIRoute))
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            for method in route.methods:
+                for status_code in KNOWN_STATUS_CODES:
+                    _counter_child(method, route.path, status_code)
+
+# تنظیمات Rate Limiting
+RATE_LIMIT_PREFIX = "rate_limit"
+RATE_LIMIT_GLOBAL_KEY = f"{RATE_LIMIT_PREFIX}:global"
+RATE_LIMIT_GLOBAL_LIMIT = 1000  # Global limit of 1000 requests per minute
+RATE_LIMIT_GLOBAL_WINDOW_MS = 60 * 1000
+RATE_LIMIT_ROUTE_LIMIT = 10  # 10 requests per IP per route every 5 seconds
+RATE_LIMIT_ROUTE_WINDOW_MS = 5 * 1000
 
 # Middleware برای Rate Limiting
+# ترتیب ثبت: این middleware داخلی‌ترین است (داخل CORS و متریک‌ها) تا پاسخ 429 هدرهای CORS داشته باشد و شمرده شود
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    if request.url.path == '/metrics':
+    if request.scope["path"] in EXCLUDED_PATHS or request.method == "OPTIONS":
         return await call_next(request)
 
-    client_ip = request.client.host
-    key_prefix = 'rate_limit'
-    now = int(datetime.utcnow().timestamp())
-    window_size = 60  # 1-minute window
-    window_start = now - (now % window_size)
-    ip_key = f"{key_prefix}:ip:{client_ip}:{window_start}"
-    global_key = f"{key_prefix}:global:{window_start}"
+    # مانند default_identifier در fastapi-limiter: اولین IP در X-Forwarded-For (پشت traefik)، در غیر این صورت IP اتصال
+    forwarded = request.headers.get("x-forwarded-for")
+    client_ip = forwarded.split(",")[0].strip() if forwarded else request.client.host
+    # محدودیت IP به ازای هر route اعمال می‌شود؛ مسیرهای ناشناخته یک bucket مشترک دارند
+    path = request.scope["path"]
+    route_path = path if path in _route_paths else "unknown"
+    ip_key = f"{RATE_LIMIT_PREFIX}:ip:{client_ip}:{route_path}"
 
-    # Global rate limit
-    global_limit = 1000  # Global limit of 1000 requests per minute
+    try:
+        exceeded, retry_after_ms = await check_rate_limit(
+            ip_key, RATE_LIMIT_GLOBAL_KEY,
+            RATE_LIMIT_ROUTE_LIMIT, RATE_LIMIT_ROUTE_WINDOW_MS,
+            RATE_LIMIT_GLOBAL_LIMIT, RATE_LIMIT_GLOBAL_WINDOW_MS,
+            int(time.time() * 1000), uuid.uuid4().hex,
+        )
+    except (RedisConnectionError, RedisTimeoutError) as e:
+        # fail-open فقط برای در دسترس نبودن Redis؛ سایر خطاها (مثلا WRONGTYPE) پنهان نمی‌شوند
+        logger.warning("Rate limit check skipped for IP: %s (%s)", client_ip, e)
+        exceeded = 0
+    if exceeded:
+        limit_name = "global" if exceeded == GLOBAL_LIMIT_EXCEEDED else "route"
+        logger.warning("Rate limit (%s) exceeded for IP: %s", limit_name, client_ip)
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too Many Requests"},
+            headers={"Retry-After": str(max(1, -(-retry_after_ms // 1000)))},
+        )
 
-    if client_ip == '127.0.0.1':
-        ip_limit = 100  # Higher limit for localhost
-    else:
-        ip_limit = 5  # Default limit
-        country_code = 'unknown'
-        ip_limit = 5  # Default limit when GeoIP is unavailable
-        
     response = await call_next(request)
     return response
 
+# Middleware برای رهگیری درخواست‌ها و محاسبه متریک‌ها
+@app.middleware("http")
+async def prometheus_middleware(request: Request, call_next):
+    if request.scope["path"] in EXCLUDED_PATHS:
+        return await call_next(request)
+
+    method = request.method
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request from IP: %s, Endpoint: %s, Method: %s", request.client.host, request.scope['path'], method)
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    # مسیر قالب route پس از مسیریابی در scope قرار می‌گیرد؛ پاسخ‌های 429 به مسیریابی نمی‌رسند پس
+    # مسیرهای ثابت شناخته‌شده مستقیما استفاده می‌شوند و بقیه یک برچسب مشترک دارند
+    route = request.scope.get("route")
+    if route is not None:
+        endpoint = route.path
+    else:
+        endpoint = request.scope["path"] if request.scope["path"] in _route_paths else "unknown"
+    label_key = (method, endpoint, response.status_code)
+    counter = _counter_children.get(label_key)
+    if counter is None:
+        counter = _counter_child(*label_key)
+    latency = _latency_children.get(label_key)
+    if latency is None:
+        latency = _latency_child(*label_key)
+    counter.inc()
+    latency.observe(elapsed)
+    return response
+
+# افزودن CORS Middleware (آخرین middleware ثبت‌شده بیرونی‌ترین لایه است)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # اعتبارسنجی db_index
 def validate_db_index(db_index: int, max_dbs: int = 15):
     if not isinstance(db_index, int) or db_index < 0 or db_index > max_dbs:
-        raise ValueError(f"db_index must be an integer between 0 and {max_dbs}.")
+        raise HTTPException(status_code=400, detail=f"db_index must be an integer between 0 and {max_dbs}.")
+
+# کلیدهای Rate Limiting در db 0 برای کاربران رزرو شده‌اند
+def validate_key(key: str, db_index: int):
+    if db_index == 0 and key.startswith(f"{RATE_LIMIT_PREFIX}:"):
+        raise HTTPException(status_code=400, detail=f"Keys starting with '{RATE_LIMIT_PREFIX}:' are reserved in db_index 0.")
 
-# دریافت اتصال Redis همگام (برای عملیات داده)
-def get_redis_connection(db_index: int, max_retries: int = 3, max_dbs: int = 15):
+# دریافت اتصال Redis ناهمگام (برای عملیات داده)
+def get_redis_connection(db_index: int, max_dbs: int = 15):
     validate_db_index(db_index, max_dbs)
-    for attempt in range(max_retries):
-        try:
-            if db_index not in redis_connections or not redis_connections[db_index].ping():
-                redis_connections[db_index] = redis.Redis(
-                    host=config['REDIS_HOST'],
-                    port=config['REDIS_PORT'],
-                    password=config['REDIS_PASSWORD'],
-                    decode_responses=True,
-                    db=db_index,
-                )
-            return redis_connections[db_index]
-        except (redis.ConnectionError, redis.TimeoutError) as e:
-            if attempt == max_retries - 1:
-                raise Exception(f"Failed to connect to Redis on db_index {db_index} after {max_retries} attempts.") from e
+    return redis_connections[db_index]
 
 # مدل‌ها و روترها
-@app.post("/create", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency), Depends(RateLimiter(times=10, seconds=5))])
+@app.post("/create", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency)])
 async def create_key(data: KeyValueInput):
     """ایجاد کلید جدید"""
-    logger.info(f"Request to create key: {data.key} in db_index: {data.db_index}")
+    logger.info("Request to create key: %s in db_index: %d", data.key, data.db_index)
     try:
+        validate_key(data.key, data.db_index)
         r = get_redis_connection(data.db_index)
-        if r.exists(data.key):
-            logger.warning(f"Key {data.key} already exists in db_index: {data.db_index}")
+        if not await r.set(data.key, data.value, ex=data.ttl, nx=True):
+            logger.warning("Key %s already exists in db_index: %d", data.key, data.db_index)
             raise HTTPException(status_code=400, detail="Key already exists")
-        if data.ttl:
-            r.set(data.key, data.value, ex=data.ttl)
-        else:
-            r.set(data.key, data.value)
-        logger.info(f"Key {data.key} created successfully in db_index: {data.db_index}")
+        logger.info("Key %s created successfully in db_index: %d", data.key, data.db_index)
         return KeyValueOutput(
             key=data.key,
             value=data.value,
@@ -167,24 +250,23 @@ async def create_key(data: KeyValueInput):
             db_index=data.db_index,
             message="Key created successfully"
         )
-    except Exception as e:
-        logger.error(f"Error creating key {data.key}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error creating key %s", data.key)
+        raise HTTPException(status_code=500, detail="Internal error")
 
-@app.put("/update", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency), Depends(RateLimiter(times=10, seconds=5))])
+@app.put("/update", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency)])
 async def update_key(data: KeyValueInput):
     """به‌روزرسانی کلید موجود"""
-    logger.info(f"Request to update key: {data.key} in db_index: {data.db_index}")
+    logger.info("Request to update key: %s in db_index: %d", data.key, data.db_index)
     try:
+        validate_key(data.key, data.db_index)
         r = get_redis_connection(data.db_index)
-        if not r.exists(data.key):
-            logger.warning(f"Key {data.key} not found in db_index: {data.db_index}")
+        if not await r.set(data.key, data.value, ex=data.ttl, xx=True):
+            logger.warning("Key %s not found in db_index: %d", data.key, data.db_index)
             raise HTTPException(status_code=404, detail="Key not found")
-        if data.ttl:
-            r.set(data.key, data.value, ex=data.ttl)
-        else:
-            r.set(data.key, data.value)
-        logger.info(f"Key {data.key} updated successfully in db_index: {data.db_index}")
+        logger.info("Key %s updated successfully in db_index: %d", data.key, data.db_index)
         return KeyValueOutput(
             key=data.key,
             value=data.value,
@@ -192,22 +274,27 @@ async def update_key(data: KeyValueInput):
             db_index=data.db_index,
             message="Key updated successfully"
         )
-    except Exception as e:
-        logger.error(f"Error updating key {data.key}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error updating key %s", data.key)
+        raise HTTPException(status_code=500, detail="Internal error")
 
-@app.get("/get", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency), Depends(RateLimiter(times=10, seconds=5))])
+@app.get("/get", response_model=KeyValueOutput, dependencies=[Depends(validate_api_key_dependency)])
 async def get_key(key: str, db_index: int = Query(0)):
     """دریافت مقدار کلید"""
-    logger.info(f"Request to get key: {key} from db_index: {db_index}")
+    logger.info("Request to get key: %s from db_index: %d", key, db_index)
     try:
+        validate_key(key, db_index)
         r = get_redis_connection(db_index)
-        if not r.exists(key):
-            logger.warning(f"Key {key} not found in db_index: {db_index}")
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.ttl(key)
+            value, ttl = await pipe.execute()
+        if value is None and ttl == -2:
+            logger.warning("Key %s not found in db_index: %d", key, db_index)
             raise HTTPException(status_code=404, detail="Key not found")
-        value = r.get(key)
-        ttl = r.ttl(key)
-        logger.info(f"Key {key} retrieved successfully from db_index: {db_index}")
+        logger.info("Key %s retrieved successfully from db_index: %d", key, db_index)
         return KeyValueOutput(
             key=key,
             value=value,
@@ -215,59 +302,66 @@ async def get_key(key: str, db_index: int = Query(0)):
             db_index=db_index,
             message="Key retrieved successfully"
         )
-    except Exception as e:
-        logger.error(f"Error retrieving key {key}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error retrieving key %s", key)
+        raise HTTPException(status_code=500, detail="Internal error")
 
-@app.delete("/delete", dependencies=[Depends(validate_api_key_dependency), Depends(RateLimiter(times=10, seconds=5))])
+@app.delete("/delete", dependencies=[Depends(validate_api_key_dependency)])
 async def delete_key(key: str, db_index: int = Query(0)):
     """حذف کلید"""
-    logger.info(f"Request to delete key: {key} from db_index: {db_index}")
+    logger.info("Request to delete key: %s from db_index: %d", key, db_index)
     try:
+        validate_key(key, db_index)
         r = get_redis_connection(db_index)
-        if not r.exists(key):
-            logger.warning(f"Key {key} not found in db_index: {db_index}")
+        if not await r.delete(key):
+            logger.warning("Key %s not found in db_index: %d", key, db_index)
             raise HTTPException(status_code=404, detail="Key not found")
-        r.delete(key)
-        logger.info(f"Key {key} deleted successfully from db_index: {db_index}")
+        logger.info("Key %s deleted successfully from db_index: %d", key, db_index)
         return {"message": "Key deleted successfully", "key": key}
-    except Exception as e:
-        logger.error(f"Error deleting key {key}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error deleting key %s", key)
+        raise HTTPException(status_code=500, detail="Internal error")
 
-@app.get("/ttl", response_model=TTLResponse, dependencies=[Depends(validate_api_key_dependency), Depends(RateLimiter(times=10, seconds=5))])
+@app.get("/ttl", response_model=TTLResponse, dependencies=[Depends(validate_api_key_dependency)])
 async def get_ttl(key: str, db_index: int = Query(0)):
     """بررسی TTL یک کلید"""
-    logger.info(f"Request to get TTL for key: {key} in db_index: {db_index}")
+    logger.info("Request to get TTL for key: %s in db_index: %d", key, db_index)
     try:
+        validate_key(key, db_index)
         r = get_redis_connection(db_index)
-        ttl = r.ttl(key)
+        ttl = await r.ttl(key)
         if ttl == -2:
-            logger.warning(f"Key {key} not found in db_index: {db_index}")
+            logger.warning("Key %s not found in db_index: %d", key, db_index)
             raise HTTPException(status_code=404, detail="Key not found")
         ttl_value = ttl if ttl != -1 else "No TTL set"
-        logger.info(f"TTL for key {key} in db_index {db_index}: {ttl_value}")
+        logger.info("TTL for key %s in db_index %d: %s", key, db_index, ttl_value)
         return TTLResponse(
             key=key,
             ttl=ttl_value,
             db_index=db_index
         )
-    except Exception as e:
-        logger.error(f"Error getting TTL for key {key}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error getting TTL for key %s", key)
+        raise HTTPException(status_code=500, detail="Internal error")
     
 @app.post("/add_apikey")
 def add_apikey(api_key: str, description: Optional[str] = None, x_api_key: str = Header(...)):
     """افزودن API Key جدید"""
-    logger.info(f"Adding API Key: {api_key}")
+    logger.info("Adding API Key: %s", api_key)
     if x_api_key != ADMIN_API_KEY:
         logger.warning("Unauthorized attempt to add API Key.")
         raise HTTPException(status_code=403, detail="Unauthorized")
     try:
         add_api_key(api_key, description)
-        logger.info(f"API Key {api_key} added successfully.")
+        logger.info("API Key %s added successfully.", api_key)
         return {"message": "API Key added successfully"}
     except sqlite3.IntegrityError:
-        logger.error(f"API Key {api_key} already exists.")
+        logger.error("API Key %s already exists.", api_key)
         raise HTTPException(status_code=400, detail="API Key already exists")
 